@@ -0,0 +1,70 @@
+import struct
+import msgpack
+import orjson
+from fastapi import WebSocket
+
+# Formatos de fio negociados por subprotocolo do WebSocket (ou ?format=).
+# O payload canônico de uma mensagem é JSON (o mesmo texto vai para o Redis,
+# o histórico e o WAL); cada formato o converte no máximo uma vez por
+# mensagem e processo, e o frame resultante é compartilhado por todos os
+# sockets daquele formato.
+class JsonCodec:
+    name = "json"
+    subprotocol = "chat.json"
+
+    def encode(self, obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def from_json(self, payload: str) -> str:
+        return payload
+
+    def batch(self, frames) -> str:
+        # Junta frames já serializados sem decodificá-los novamente
+        return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    subprotocol = "chat.msgpack"
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj)
+
+    def from_json(self, payload: str) -> bytes:
+        return msgpack.packb(orjson.loads(payload))
+
+    def batch(self, frames) -> bytes:
+        n = len(frames)
+        if n < 16:
+            header = bytes([0x90 | n])
+        elif n < 0x10000:
+            header = b"\xdc" + struct.pack(">H", n)
+        else:
+            header = b"\xdd" + struct.pack(">I", n)
+        # Mapa de 2 chaves montado à mão: os frames já estão em msgpack
+        return b"\x82" + msgpack.packb("type") + msgpack.packb("batch") \
+            + msgpack.packb("messages") + header + b"".join(frames)
+
+
+json_codec = JsonCodec()
+msgpack_codec = MsgpackCodec()
+CODECS = {c.subprotocol: c for c in (json_codec, msgpack_codec)}
+
+
+# Primeiro subprotocolo suportado oferecido pelo cliente, senão ?format=,
+# senão JSON. Retorna (codec, subprotocolo aceito).
+def negotiate(ws: WebSocket):
+    for proto in ws.scope.get("subprotocols", []):
+        if proto in CODECS:
+            return CODECS[proto], proto
+    fmt = ws.query_params.get("format")
+    if fmt == msgpack_codec.name:
+        return msgpack_codec, None
+    return json_codec, None
+
+
+# Frame recebido: texto é JSON, binário é msgpack
+def decode_frame(message: dict):
+    if message.get("bytes") is not None:
+        return msgpack.unpackb(message["bytes"])
+    return orjson.loads(message["text"])
@@ -1,9 +1,76 @@
+import os
+import socket
+from typing import Dict, List, Literal
 from pydantic_settings import BaseSettings
 import redis.asyncio as redis_async
+from app.sharding import HashRing
 
 class Settings(BaseSettings):
     MONGO_URI: str = "mongodb://mongo:27017"
     REDIS_URI: str = "redis://redis:6379/0"
+    # Vários Redis: as salas são distribuídas por hash consistente (JSON)
+    REDIS_URIS: List[str] = []
+    # Conexões por shard; acima disso os comandos esperam por uma livre
+    REDIS_MAX_CONNECTIONS: int = 100
+    NODE_ID: str = ""
+    # Redis e MongoDB em memória (fakeredis/mongomock-motor), para rodar sem
+    # redis-server e mongod; estado não é compartilhado entre processos
+    FAKE_BACKENDS: bool = False
+    # Drenagem no SIGTERM
+    DRAIN_TIMEOUT: float = 10.0
+    RECONNECT_JITTER_MS: int = 5000
+    # Fila de saída por socket
+    SEND_QUEUE_SIZE: int = 100
+    SEND_OVERFLOW_POLICY: Literal["drop_oldest", "coalesce", "disconnect"] = "drop_oldest"
+    SEND_TIMEOUT: float = 5.0
+    SEND_COALESCE_MAX: int = 1000  # frames num batch do `coalesce`
+    # Rate limit: RATE_LIMIT mensagens a cada RATE_WINDOW_MS, por usuário/sala
+    RATE_LIMIT: int = 5
+    RATE_WINDOW_MS: int = 1000
+    RATE_LIMIT_STRATEGY: Literal["token_bucket", "sliding_log", "fixed_window"] = "token_bucket"
+    RATE_LIMIT_ROOMS: Dict[str, int] = {}  # limite por sala, ex.: {"avisos": 1}
+    RATE_LIMIT_USERS: Dict[str, int] = {}  # limite por usuário (tem prioridade)
+    RATE_LIMIT_LOCAL: bool = True  # pré-checagem em memória antes do Redis
+    # Presença: usuário sai da lista sem heartbeat por PRESENCE_TTL segundos
+    PRESENCE_TTL: int = 30
+    PRESENCE_SWEEP_INTERVAL: float = 5.0
+    # Persistência em lote (write-behind) no MongoDB
+    PERSIST_BATCH_SIZE: int = 500
+    PERSIST_FLUSH_MS: int = 50
+    PERSIST_MAX_RETRY_DELAY: float = 5.0
+    PERSIST_DRAIN_TIMEOUT: float = 10.0
+    PERSIST_WAL: bool = True  # Redis Stream como buffer write-ahead
+    PERSIST_CLAIM_IDLE_MS: int = 30000
 
 settings = Settings()
-redis = redis_async.from_url(settings.REDIS_URI, decode_responses=True)
\ No newline at end of file
+if settings.FAKE_BACKENDS:
+    # O fakeredis não bloqueia no XREADGROUP ... BLOCK: sem WAL, a persistência
+    # usa a fila em memória (que é o que faz sentido num único processo)
+    settings.PERSIST_WAL = False
+
+# Identifica este processo (vários workers podem compartilhar o mesmo NODE_ID)
+node_id = f"{settings.NODE_ID or socket.gethostname()}-{os.getpid()}"
+
+def _redis_client(uri: str):
+    options = {
+        "decode_responses": True,
+        "connection_pool_class": redis_async.BlockingConnectionPool,
+        "max_connections": settings.REDIS_MAX_CONNECTIONS,
+    }
+    if settings.FAKE_BACKENDS:
+        # pip install "fakeredis[lua]" (os scripts Lua precisam do lupa)
+        from fakeredis import FakeServer, aioredis as fake_aioredis
+        return fake_aioredis.FakeRedis(server=FakeServer(), **options)
+    return redis_async.from_url(uri, **options)
+
+redis_uris = settings.REDIS_URIS or [settings.REDIS_URI]
+redis_shards = [_redis_client(uri) for uri in redis_uris]
+redis = redis_shards[0]
+ring = HashRing(redis_uris)
+
+def shard_index(room: str) -> int:
+    return ring.get(room)
+
+# Redis responsável pela sala: canal, histórico, rate limit, presença e WAL
+def redis_for(room: str):
+    return redis_shards[shard_index(room)]
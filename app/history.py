@@ -0,0 +1,86 @@
+import base64
+import binascii
+import orjson
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING
+from app.config import redis_for
+from app.utils import RECENT_SIZE
+
+# Só os campos que o cliente renderiza
+FIELDS = ("id", "user_id", "content", "timestamp")
+PROJECTION = {"user_id": 1, "content": 1, "timestamp": 1}
+HISTORY_INDEX = [("room", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+async def ensure_indexes(collection):
+    await collection.create_index(HISTORY_INDEX, name="room_timestamp_id")
+
+
+# Cursor opaco com a posição (timestamp, id) da última mensagem da página
+def encode_cursor(msg: dict) -> str:
+    raw = f"{msg['timestamp']}|{msg['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, msg_id = raw.split("|")
+        return timestamp, str(ObjectId(msg_id))
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise InvalidCursor(cursor)
+
+
+def _position(msg: dict):
+    return msg["timestamp"], msg["id"]
+
+
+# Cursor para continuar depois da cauda `recent:{room}` (itens em JSON)
+def recent_cursor(recent) -> str:
+    msgs = [msg for msg in map(orjson.loads, recent) if "id" in msg]
+    return encode_cursor(min(msgs, key=_position)) if msgs else None
+
+
+# Paginação por keyset em (room, timestamp, _id), do mais novo para o mais
+# antigo. A cauda quente vem da lista `recent:{room}` do Redis (que ainda
+# pode ter mensagens não gravadas pelo write-behind); o resto do MongoDB.
+# A ordem do LPUSH não é a do timestamp (sockets e workers concorrentes,
+# relógios diferentes), então a cauda é ordenada antes de ser cortada.
+async def get_history(collection, room: str, before=None, limit: int = 50) -> dict:
+    position = decode_cursor(before) if before else None
+    messages = []
+    for raw in await redis_for(room).lrange(f"recent:{room}", 0, RECENT_SIZE - 1):
+        msg = orjson.loads(raw)
+        if "id" not in msg or (position and _position(msg) >= position):
+            continue
+        messages.append({k: msg.get(k) for k in FIELDS})
+    messages.sort(key=_position, reverse=True)
+    del messages[limit:]
+    if messages:
+        position = _position(messages[-1])
+
+    if len(messages) < limit:
+        query = {"room": room}
+        if position:
+            timestamp, msg_id = position
+            oid = ObjectId(msg_id)
+            # O limite em timestamp mantém a varredura num único intervalo do índice
+            query["timestamp"] = {"$lte": timestamp}
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": oid}},
+            ]
+        cursor = collection.find(query, PROJECTION) \
+            .sort([("timestamp", DESCENDING), ("_id", DESCENDING)]) \
+            .limit(limit - len(messages))
+        async for doc in cursor:
+            doc["id"] = str(doc.pop("_id"))
+            messages.append(doc)
+
+    next_cursor = encode_cursor(messages[-1]) if len(messages) == limit else None
+    return {"messages": messages, "next": next_cursor}
@@ -1,76 +1,168 @@
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from motor.motor_asyncio import AsyncIOMotorClient
-from app.config import settings, redis
-from app.models import MessageIn, MessageOut
-from app.utils import rate_limit_check, set_online, get_recent, add_recent
-import json
+import logging
+import signal
+import time
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from pydantic import ValidationError
+from app import metrics
+from app.codec import decode_frame, negotiate
+from app.config import settings, node_id
+from app.manager import manager, room_channel
+from app.history import InvalidCursor, ensure_indexes, get_history, recent_cursor
+from app.models import HistoryRequest, MessageIn, MessageOut
+from app.persistence import MessageWriter
+from app.presence import PresenceSweeper, get_online, heartbeat, join, leave
+from app.utils import send_message, get_recent_raw
+from bson import ObjectId
+import orjson
 from datetime import datetime
 
-app = FastAPI()
+log = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # MongoDB
-mongo_client = AsyncIOMotorClient(settings.MONGO_URI)
+if settings.FAKE_BACKENDS:
+    # pip install mongomock-motor
+    from mongomock_motor import AsyncMongoMockClient
+    mongo_client = AsyncMongoMockClient(settings.MONGO_URI)
+else:
+    from motor.motor_asyncio import AsyncIOMotorClient
+    mongo_client = AsyncIOMotorClient(settings.MONGO_URI)
 messages_collection = mongo_client.chatdb.messages
+message_writer = MessageWriter(messages_collection)
+presence_sweeper = PresenceSweeper(manager)
 
-# WebSocket Manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}  # room: set(WebSocket)
+# SIGTERM: drena os sockets antes de devolver o sinal ao servidor (uvicorn),
+# que então encerra o processo e roda o shutdown (que drena a persistência)
+def install_drain_handler():
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
 
-    async def connect(self, ws: WebSocket, room: str):
-        await ws.accept()
-        self.active_connections.setdefault(room, set()).add(ws)
+    async def drain_and_exit():
+        await manager.drain(settings.DRAIN_TIMEOUT)
+        loop.remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, previous)
+        signal.raise_signal(signal.SIGTERM)
 
-    def disconnect(self, ws: WebSocket, room: str):
-        self.active_connections.get(room, set()).discard(ws)
+    def on_sigterm():
+        if not manager.draining:
+            asyncio.ensure_future(drain_and_exit())
 
-    async def broadcast(self, room: str, message: dict):
-        for ws in self.active_connections.get(room, []):
-            await ws.send_json(message)
+    try:
+        loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+    except (RuntimeError, NotImplementedError):
+        # Loop fora da thread principal (ex.: TestClient) ou Windows: sem drenagem
+        log.warning("drenagem no SIGTERM indisponível neste event loop")
 
-manager = ConnectionManager()
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes(messages_collection)
+    message_writer.start()
+    presence_sweeper.start()
+    metrics.loop_lag.start()
+    install_drain_handler()
 
-@app.websocket("/ws/{room}/{user_id}")
-async def chat_ws(ws: WebSocket, room: str, user_id: str):
-    await manager.connect(ws, room)
-    await set_online(room, user_id)
-    # Envia histórico recente ao conectar
-    recent = await get_recent(room)
-    await ws.send_json({"type": "recent", "messages": recent})
+@app.on_event("shutdown")
+async def shutdown():
+    await metrics.loop_lag.stop()
+    await presence_sweeper.stop()
+    await manager.close()
+    await message_writer.stop()
 
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(f"chat:{room}")
+@app.get("/health")
+async def health():
+    # 503 durante a drenagem, para o balanceador parar de mandar conexões
+    if manager.draining:
+        return ORJSONResponse({"status": "draining", "node_id": node_id}, status_code=503)
+    return {"status": "ok", "node_id": node_id}
 
+@app.get("/stats")
+async def stats():
+    return manager.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(manager), media_type="text/plain; version=0.0.4")
+
+@app.get("/rooms/{room}/messages")
+async def room_messages(room: str, before: str = None, limit: int = Query(50, ge=1, le=100)):
     try:
-        async def redis_listener():
-            async for msg in pubsub.listen():
-                if msg["type"] == "message":
-                    await manager.broadcast(room, json.loads(msg["data"]))
+        return await get_history(messages_collection, room, before, limit)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-        listener_task = asyncio.create_task(redis_listener())
+@app.get("/rooms/{room}/online")
+async def room_online(room: str, after: str = None, limit: int = Query(100, ge=1, le=1000)):
+    return await get_online(room, after, limit)
+
+@app.websocket("/ws/{room}/{user_id}")
+async def chat_ws(ws: WebSocket, room: str, user_id: str):
+    if manager.draining:
+        # Aceita antes de fechar: fechar no handshake vira HTTP 403 e o
+        # navegador só enxerga 1006, sem o código 1013 que dispara o reconnect
+        await ws.accept()
+        await ws.close(code=1013)
+        return
+    codec, subprotocol = negotiate(ws)
+    client = await manager.connect(ws, room, codec, subprotocol)
+    joined = False
+    try:
+        await join(room, user_id)
+        joined = True
+        # Envia histórico recente ao conectar
+        # (os itens do Redis já estão em JSON e não são decodificados de novo)
+        recent = await get_recent_raw(room)
+        next_cursor = recent_cursor(recent)
+        client.send(codec.from_json(
+            '{"type":"recent","messages":[' + ",".join(recent) + '],"next":'
+            + orjson.dumps(next_cursor).decode() + "}"
+        ))
 
         while True:
-            data = await ws.receive_json()
-            msg_in = MessageIn(**data)
-            allowed = await rate_limit_check(room, user_id)
-            if not allowed:
-                await ws.send_json({"type": "error", "message": "Rate limit exceeded!"})
+            frame = await ws.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            start = time.perf_counter()
+            data = decode_frame(frame)
+            if data.get("type") == "heartbeat":
+                await heartbeat(room, user_id)
+                continue
+            if data.get("type") == "history":
+                try:
+                    req = HistoryRequest(**data)
+                    page = await get_history(messages_collection, room, req.before, req.limit)
+                except (ValidationError, InvalidCursor):
+                    client.send(codec.encode({"type": "error", "message": "Invalid history request!"}))
+                    continue
+                client.send(codec.encode({"type": "history", **page}))
                 continue
-            msg_out = MessageOut(
+            msg_in = MessageIn(**data)
+            oid = ObjectId()
+            doc = MessageOut(
+                id=str(oid),
                 user_id=user_id,
                 room=room,
                 content=msg_in.content,
-                timestamp=datetime.utcnow().isoformat()
+                timestamp=datetime.utcnow().isoformat(timespec="microseconds")
+            ).dict()
+            # Serializado uma vez: o mesmo JSON vai para o histórico, o WAL e o canal
+            payload = orjson.dumps(doc).decode()
+            metrics.observe("parse", time.perf_counter() - start)
+            metrics.inc("messages_received")
+            allowed = await send_message(
+                room, user_id, payload, room_channel(room),
+                message_writer.wal_stream, str(oid),
             )
-            await messages_collection.insert_one(msg_out.dict())
-            await add_recent(room, msg_out.dict())
-            await redis.publish(f"chat:{room}", json.dumps(msg_out.dict()))
-
-        await listener_task
+            if not allowed:
+                metrics.inc("messages_rate_limited")
+                client.send(codec.encode({"type": "error", "message": "Rate limit exceeded!"}))
+                continue
+            message_writer.enqueue(doc, oid)
     except WebSocketDisconnect:
-        manager.disconnect(ws, room)
-        await ws.close()
+        pass
     finally:
-        await pubsub.unsubscribe(f"chat:{room}")
-        await pubsub.close()
\ No newline at end of file
+        await manager.disconnect(client)
+        if joined:
+            await leave(room, user_id)
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import random
+from collections import deque
+from fastapi import WebSocket
+from app import metrics
+from app.codec import json_codec
+from app.config import settings, node_id, redis_shards, shard_index
+
+# Mensagens do pubsub processadas entre cada cessão do event loop; bem abaixo
+# de SEND_QUEUE_SIZE para que um cliente rápido nunca encha a fila
+LISTEN_YIELD_EVERY = 16
+
+log = logging.getLogger(__name__)
+
+
+def room_channel(room: str) -> str:
+    return f"chat:{room}"
+
+
+# Socket com fila de saída limitada e uma task escritora própria:
+# um cliente lento nunca atrasa a entrega para o resto da sala.
+class Client:
+    def __init__(self, ws: WebSocket, room: str, manager: "ConnectionManager", codec=json_codec):
+        self.ws = ws
+        self.room = room
+        self.codec = codec
+        self.manager = manager
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.writer_task = asyncio.create_task(self._writer())
+
+    def send(self, frame):
+        if self.closed:
+            return
+        if len(self.queue) >= settings.SEND_QUEUE_SIZE:
+            policy = settings.SEND_OVERFLOW_POLICY
+            if policy == "disconnect":
+                self.manager.dropped_frames += len(self.queue) + 1
+                self.manager.slow_disconnects += 1
+                self.abort(code=1013)
+                return
+            if policy == "coalesce":
+                self._coalesce()
+            else:
+                self.queue.popleft()
+                self.manager.dropped_frames += 1
+        self.queue.append(frame)
+        self.ready.set()
+
+    # Junta os pendentes numa única entrada (lista plana de frames, virada em
+    # frame `batch` só no envio), limitada a SEND_COALESCE_MAX frames: os mais
+    # antigos além disso são descartados
+    def _coalesce(self):
+        merged = []
+        for item in self.queue:
+            if isinstance(item, list):
+                merged.extend(item)
+            else:
+                merged.append(item)
+        excess = len(merged) - settings.SEND_COALESCE_MAX
+        if excess > 0:
+            del merged[:excess]
+            self.manager.dropped_frames += excess
+        self.queue.clear()
+        self.queue.append(merged)
+
+    async def close(self):
+        self.closed = True
+        self.writer_task.cancel()
+        try:
+            await self.writer_task
+        except asyncio.CancelledError:
+            pass
+
+    def abort(self, code: int = 1011):
+        self.closed = True
+        self.queue.clear()
+        self.writer_task.cancel()
+        asyncio.create_task(self._close_ws(code))
+
+    async def _close_ws(self, code: int):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                frame = self.queue.popleft()
+                if isinstance(frame, list):
+                    frame = self.codec.batch(frame)
+                # asyncio.timeout, e não wait_for: no Python 3.11 o wait_for pode
+                # engolir o cancelamento se o envio terminar no mesmo instante
+                async with asyncio.timeout(settings.SEND_TIMEOUT):
+                    if isinstance(frame, bytes):
+                        await self.ws.send_bytes(frame)
+                    else:
+                        await self.ws.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket morto ou travado: para de enfileirar e fecha a conexão
+            self.abort()
+
+
+# WebSocket Manager
+# Um único pubsub por processo e por shard do Redis: cada sala é assinada
+# quando o primeiro usuário entra e desassinada quando o último sai, e cada
+# mensagem do Redis é entregue uma única vez aos sockets locais da sala.
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections = {}  # room: set(Client)
+        self.pubsubs = {}  # shard: PubSub
+        self.listener_tasks = {}  # shard: Task
+        self.shard_rooms = {}  # shard: número de salas assinadas
+        self.lock = asyncio.Lock()
+        self.draining = False
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+
+    async def connect(self, ws: WebSocket, room: str, codec=json_codec, subprotocol=None) -> Client:
+        await ws.accept(subprotocol=subprotocol)
+        async with self.lock:
+            conns = self.active_connections.get(room)
+            if not conns:
+                try:
+                    await self._subscribe(room)
+                except Exception:
+                    # Redis fora: o Client (e sua task escritora) nem chega a
+                    # existir, e o socket já aceito é fechado aqui
+                    try:
+                        await ws.close(code=1011)
+                    except Exception:
+                        pass
+                    raise
+                conns = self.active_connections[room] = set()
+            client = Client(ws, room, self, codec)
+            conns.add(client)
+        return client
+
+    async def disconnect(self, client: Client):
+        await client.close()
+        async with self.lock:
+            conns = self.active_connections.get(client.room)
+            if conns is None:
+                return
+            conns.discard(client)
+            if not conns:
+                del self.active_connections[client.room]
+                await self._unsubscribe(client.room)
+
+    def broadcast(self, room: str, payload: str):
+        # Um frame por formato, compartilhado por todos os sockets que o usam.
+        # Cópia do set: sockets podem sair durante o envio
+        frames = {}
+        for client in list(self.active_connections.get(room, ())):
+            frame = frames.get(client.codec.name)
+            if frame is None:
+                frame = frames[client.codec.name] = client.codec.from_json(payload)
+            client.send(frame)
+
+    def clients(self):
+        return [c for conns in self.active_connections.values() for c in conns]
+
+    def stats(self) -> dict:
+        depths = [len(c.queue) for c in self.clients()]
+        return {
+            "node_id": node_id,
+            "draining": self.draining,
+            "rooms": len(self.active_connections),
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "dropped_frames": self.dropped_frames,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+    # Drenagem no shutdown: para de aceitar sockets, avisa cada cliente para
+    # reconectar (com atraso aleatório, para não voltarem todos juntos),
+    # espera as filas de saída esvaziarem e fecha com 1012 (Service Restart).
+    async def drain(self, timeout: float):
+        self.draining = True
+        clients = self.clients()
+        for client in clients:
+            client.send(client.codec.encode({
+                "type": "reconnect",
+                "node_id": node_id,
+                "after_ms": random.randint(0, settings.RECONNECT_JITTER_MS),
+            }))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline and any(c.queue and not c.closed for c in clients):
+            await asyncio.sleep(0.05)
+        for client in clients:
+            if not client.closed:
+                client.abort(code=1012)
+
+    async def close(self):
+        async with self.lock:
+            clients = self.clients()
+            self.active_connections.clear()
+            for shard in list(self.listener_tasks):
+                await self._stop_listener(shard)
+        for client in clients:
+            await client.close()
+
+    async def _subscribe(self, room: str):
+        shard = shard_index(room)
+        pubsub = self.pubsubs.get(shard)
+        if pubsub is None:
+            pubsub = self.pubsubs[shard] = redis_shards[shard].pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(room_channel(room))
+        self.shard_rooms[shard] = self.shard_rooms.get(shard, 0) + 1
+        task = self.listener_tasks.get(shard)
+        if task is None or task.done():
+            self.listener_tasks[shard] = asyncio.create_task(self._listen(shard))
+
+    async def _unsubscribe(self, room: str):
+        shard = shard_index(room)
+        await self.pubsubs[shard].unsubscribe(room_channel(room))
+        self.shard_rooms[shard] -= 1
+        if not self.shard_rooms[shard]:
+            await self._stop_listener(shard)
+
+    async def _stop_listener(self, shard: int):
+        task = self.listener_tasks.pop(shard, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        pubsub = self.pubsubs.pop(shard, None)
+        if pubsub is not None:
+            await pubsub.close()
+        self.shard_rooms.pop(shard, None)
+
+    async def _listen(self, shard: int):
+        prefix = room_channel("")
+        received = 0
+        while True:
+            pubsub = self.pubsubs.get(shard)
+            if pubsub is None:
+                return
+            try:
+                async for msg in pubsub.listen():
+                    if msg["type"] != "message":
+                        continue
+                    room = msg["channel"][len(prefix):]
+                    try:
+                        # O payload já vem serializado do publish: repassa como está
+                        with metrics.timed("fanout"):
+                            self.broadcast(room, msg["data"])
+                    except Exception:
+                        # Um socket com erro não pode derrubar o listener do shard
+                        log.exception("fanout: falha ao repassar mensagem da sala %s", room)
+                    received += 1
+                    if received % LISTEN_YIELD_EVERY == 0:
+                        # Uma rajada já bufferizada não cede o loop sozinha: deixa
+                        # os escritores drenarem as filas antes de enfileirar mais
+                        await asyncio.sleep(0)
+                return
+            except Exception:
+                # Conexão caiu: sem reconectar, as salas do shard ficariam mudas
+                log.exception("pubsub do shard %d caiu; reconectando", shard)
+                await asyncio.sleep(1)
+                await self._reconnect(shard, pubsub)
+
+    async def _reconnect(self, shard: int, pubsub):
+        async with self.lock:
+            if self.pubsubs.get(shard) is not pubsub:
+                return  # parado ou já refeito enquanto esperávamos
+            fresh = redis_shards[shard].pubsub(ignore_subscribe_messages=True)
+            try:
+                await fresh.subscribe(*pubsub.channels)
+            except Exception:
+                # Redis ainda fora: o listen antigo falha de novo e tentamos outra vez
+                log.exception("pubsub do shard %d: reinscrição falhou", shard)
+                await fresh.close()
+                return
+            self.pubsubs[shard] = fresh
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+
+manager = ConnectionManager()
@@ -0,0 +1,149 @@
+import asyncio
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from app.config import node_id
+
+# Métricas do processo no formato texto do Prometheus, sem dependências.
+# Estágios do caminho quente:
+#   parse       - decodificar o frame, validar MessageIn e montar/serializar MessageOut
+#   rate_limit  - pré-checagem local do rate limit
+#   redis_send  - script Lua: rate limit no Redis, histórico, WAL e publish
+#   mongo_insert - um insert_many do pipeline de persistência (por lote)
+#   fanout      - enfileirar o frame para os sockets locais da sala
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+stages = {}  # estágio: Histogram
+counters = {}  # nome: valor
+
+
+def observe(stage: str, seconds: float):
+    hist = stages.get(stage)
+    if hist is None:
+        hist = stages[stage] = Histogram()
+    hist.observe(seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def inc(name: str, value: int = 1):
+    counters[name] = counters.get(name, 0) + value
+
+
+# Atraso do event loop: quanto um sleep de INTERVAL demora além do pedido
+class LoopLagMonitor:
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.INTERVAL)
+            self.lag = max(0.0, loop.time() - start - self.INTERVAL)
+            self.max_lag = max(self.max_lag, self.lag)
+
+
+loop_lag = LoopLagMonitor()
+
+
+def resident_memory_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Fora do Linux: pico de memória, não o valor atual (e sem `resource`
+        # no Windows)
+        try:
+            import resource
+        except ImportError:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(manager) -> str:
+    node = f'node_id="{_label(node_id)}"'
+    lines = [
+        "# HELP chat_stage_seconds Duração de cada estágio do caminho quente.",
+        "# TYPE chat_stage_seconds histogram",
+    ]
+    for stage, hist in sorted(stages.items()):
+        labels = f'{node},stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, hist.counts):
+            cumulative += count
+            lines.append(f'chat_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'chat_stage_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+        lines.append(f"chat_stage_seconds_sum{{{labels}}} {hist.sum}")
+        lines.append(f"chat_stage_seconds_count{{{labels}}} {hist.count}")
+
+    stats = manager.stats()
+    all_counters = {
+        **counters,
+        "dropped_frames": stats["dropped_frames"],
+        "slow_disconnects": stats["slow_disconnects"],
+    }
+    for name, value in sorted(all_counters.items()):
+        lines.append(f"# TYPE chat_{name}_total counter")
+        lines.append(f"chat_{name}_total{{{node}}} {value}")
+
+    lines.append("# HELP chat_connections Sockets abertos por sala neste processo.")
+    lines.append("# TYPE chat_connections gauge")
+    for room, conns in sorted(manager.active_connections.items()):
+        lines.append(f'chat_connections{{{node},room="{_label(room)}"}} {len(conns)}')
+
+    gauges = {
+        "chat_send_queue_depth": stats["queue_depth_total"],
+        "chat_send_queue_depth_max": stats["queue_depth_max"],
+        "chat_draining": int(stats["draining"]),
+        "chat_event_loop_lag_seconds": loop_lag.lag,
+        "chat_event_loop_lag_max_seconds": loop_lag.max_lag,
+        "process_resident_memory_bytes": resident_memory_bytes(),
+    }
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{{{node}}} {value}")
+    return "\n".join(lines) + "\n"
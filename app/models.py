@@ -1,10 +1,17 @@
-from pydantic import BaseModel
+from typing import Optional
+from pydantic import BaseModel, Field
 
 class MessageIn(BaseModel):
     content: str
 
 class MessageOut(BaseModel):
+    id: str
     user_id: str
     room: str
     content: str
-    timestamp: str
\ No newline at end of file
+    timestamp: str
+
+# Página do histórico: mensagens anteriores ao cursor `before`
+class HistoryRequest(BaseModel):
+    before: Optional[str] = None
+    limit: int = Field(50, ge=1, le=100)
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import orjson
+import time
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError, WriteError
+from redis.exceptions import RedisError, ResponseError
+from app import metrics
+from app.config import settings, node_id, redis_for, redis_shards
+
+log = logging.getLogger(__name__)
+
+WAL_STREAM = "wal:messages"
+WAL_GROUP = "mongo-writer"
+DUPLICATE_KEY = 11000
+# Erros de escrita que passam numa nova tentativa (troca de primário,
+# shutdown, timeout); os demais são do próprio documento, como validação
+RETRYABLE_CODES = {6, 7, 50, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435}
+# Mensagens que o MongoDB nunca vai aceitar, com o erro, no shard da sala
+DEAD_LETTER_STREAM = "wal:dead"
+DEAD_LETTER_MAXLEN = 10000
+
+
+# O `id` exposto aos clientes vira o _id do documento no MongoDB
+def to_mongo(doc: dict, oid: ObjectId) -> dict:
+    doc = {k: v for k, v in doc.items() if k != "id"}
+    doc["_id"] = oid
+    return doc
+
+
+# Persistência write-behind: as mensagens são publicadas na hora e gravadas
+# no MongoDB em lotes com insert_many(ordered=False), a cada
+# PERSIST_BATCH_SIZE documentos ou PERSIST_FLUSH_MS milissegundos.
+#
+# Com PERSIST_WAL, cada mensagem vai antes para o Redis Stream `wal:messages`
+# do shard da sala e só é confirmada (XACK) depois de gravada; cada processo
+# consome todos os shards, e entradas de um worker que caiu são recuperadas
+# com XAUTOCLAIM. O _id é gerado na aplicação, então
+# regravar um lote é idempotente. Documentos recusados de vez (validação,
+# tamanho, BSON inválido) vão para o stream `wal:dead` em vez de travar o lote.
+class MessageWriter:
+    def __init__(self, collection):
+        self.collection = collection
+        self.queue = asyncio.Queue()
+        self.consumer = node_id
+        self.task = None
+        self.stopping = False
+
+    def start(self):
+        if settings.PERSIST_WAL:
+            run = asyncio.gather(*[self._run_wal(client) for client in redis_shards])
+        else:
+            run = self._run_queue()
+        self.task = asyncio.ensure_future(run)
+
+    @property
+    def wal_stream(self):
+        return WAL_STREAM if settings.PERSIST_WAL else None
+
+    def enqueue(self, doc: dict, oid: ObjectId):
+        # No modo WAL a entrada já foi gravada no stream pelo caminho quente
+        if not settings.PERSIST_WAL:
+            self.queue.put_nowait(to_mongo(doc, oid))
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopping = True
+        self.queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(self.task, settings.PERSIST_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.error("persistência: %d mensagens não gravadas no shutdown", self.queue.qsize())
+        self.task = None
+
+    # Fila em memória
+    async def _run_queue(self):
+        while True:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + settings.PERSIST_FLUSH_MS / 1000
+            done = False
+            while len(batch) < settings.PERSIST_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    done = True
+                    break
+                batch.append(doc)
+            await self._insert(batch)
+            if done:
+                break
+        # Drena o que chegou depois do sinal de parada
+        rest = []
+        while not self.queue.empty():
+            doc = self.queue.get_nowait()
+            if doc is not None:
+                rest.append(doc)
+        if rest:
+            await self._insert(rest)
+
+    # Redis Stream como write-ahead log
+    async def _run_wal(self, client):
+        ready = False
+        while not self.stopping:
+            try:
+                if not ready:
+                    await self._create_group(client)
+                    await self._claim_orphans(client)
+                    ready = True
+                entries = await self._read_batch(client)
+                if entries:
+                    await self._flush_entries(client, entries)
+                else:
+                    await self._claim_orphans(client)
+                    # Não depende do BLOCK do servidor para ceder o event loop
+                    await asyncio.sleep(settings.PERSIST_FLUSH_MS / 1000)
+            except RedisError as e:
+                log.warning("persistência: erro no Redis: %s", e)
+                ready = False  # o stream ou o grupo podem ter sumido
+                await asyncio.sleep(1)
+            except Exception:
+                # Um erro inesperado não pode parar o consumo deste shard
+                log.exception("persistência: falha no consumo do WAL")
+                await asyncio.sleep(1)
+
+    async def _create_group(self, client):
+        try:
+            await client.xgroup_create(WAL_STREAM, WAL_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _read_batch(self, client):
+        entries = []
+        deadline = time.monotonic() + settings.PERSIST_FLUSH_MS / 1000
+        block = settings.PERSIST_FLUSH_MS
+        while len(entries) < settings.PERSIST_BATCH_SIZE and not self.stopping:
+            resp = await client.xreadgroup(
+                WAL_GROUP, self.consumer, {WAL_STREAM: ">"},
+                count=settings.PERSIST_BATCH_SIZE - len(entries), block=block,
+            )
+            if resp:
+                entries.extend(resp[0][1])
+            elif not entries:
+                break
+            block = int((deadline - time.monotonic()) * 1000)
+            if block <= 0:
+                break
+        return entries
+
+    async def _claim_orphans(self, client):
+        start = "0-0"
+        while True:
+            start, entries, *_ = await client.xautoclaim(
+                WAL_STREAM, WAL_GROUP, self.consumer,
+                min_idle_time=settings.PERSIST_CLAIM_IDLE_MS,
+                start_id=start, count=settings.PERSIST_BATCH_SIZE,
+            )
+            entries = [e for e in entries if e and e[1]]
+            if entries:
+                await self._flush_entries(client, entries)
+            if start == "0-0":
+                break
+
+    async def _flush_entries(self, client, entries):
+        docs = []
+        for entry_id, fields in entries:
+            try:
+                docs.append(to_mongo(orjson.loads(fields["doc"]), ObjectId(fields["id"])))
+            except Exception as e:
+                # Entrada malformada: nenhuma nova leitura vai consertá-la
+                await self._dead_letter(client, fields.get("id", entry_id), fields.get("doc", ""), e)
+        await self._insert(docs)
+        ids = [entry_id for entry_id, _ in entries]
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.xack(WAL_STREAM, WAL_GROUP, *ids)
+            pipe.xdel(WAL_STREAM, *ids)
+            await pipe.execute()
+
+    async def _insert(self, docs):
+        delay = 0.1
+        while docs:
+            try:
+                with metrics.timed("mongo_insert"):
+                    await self.collection.insert_many(docs, ordered=False)
+                metrics.inc("messages_persisted", len(docs))
+                return
+            except BulkWriteError as e:
+                metrics.inc("messages_persisted", e.details.get("nInserted", 0))
+                if not e.details.get("writeConcernErrors"):
+                    # Lote regravado após falha: duplicatas já estão salvas
+                    errors = [err for err in e.details.get("writeErrors", [])
+                              if err.get("code") != DUPLICATE_KEY]
+                    retry = []
+                    for err in errors:
+                        doc = docs[err["index"]]
+                        if err.get("code") in RETRYABLE_CODES:
+                            retry.append(doc)
+                        else:
+                            await self._reject(doc, err.get("errmsg"))
+                    docs = retry
+                    if not docs:
+                        return
+                log.warning("persistência: falha no insert_many: %s", e)
+            except InvalidDocument as e:
+                # O driver recusa o lote antes de enviar e não diz qual documento
+                log.warning("persistência: lote com documento inválido: %s", e)
+                docs = await self._insert_each(docs)
+                if not docs:
+                    return
+            except PyMongoError as e:
+                log.warning("persistência: falha no insert_many: %s", e)
+            metrics.inc("persist_retries")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.PERSIST_MAX_RETRY_DELAY)
+
+    # Grava um a um, separando os recusados; devolve o que ainda deve ser
+    # tentado de novo (a partir da primeira falha transitória)
+    async def _insert_each(self, docs):
+        for i, doc in enumerate(docs):
+            try:
+                await self.collection.insert_one(doc)
+                metrics.inc("messages_persisted")
+            except DuplicateKeyError:
+                pass
+            except InvalidDocument as e:
+                await self._reject(doc, e)
+            except WriteError as e:
+                if e.code in RETRYABLE_CODES:
+                    return docs[i:]
+                await self._reject(doc, e)
+            except PyMongoError:
+                return docs[i:]
+        return []
+
+    async def _reject(self, doc, error):
+        client = redis_for(str(doc.get("room", "")))
+        await self._dead_letter(client, doc.get("_id"), orjson.dumps(doc, default=str), error)
+
+    async def _dead_letter(self, client, oid, doc, error):
+        metrics.inc("messages_dead_lettered")
+        log.error("persistência: mensagem %s recusada, enviada para %s: %s", oid, DEAD_LETTER_STREAM, error)
+        try:
+            await client.xadd(
+                DEAD_LETTER_STREAM, {"id": str(oid), "doc": doc, "error": str(error)},
+                maxlen=DEAD_LETTER_MAXLEN, approximate=True,
+            )
+        except RedisError as e:
+            log.error("persistência: dead letter indisponível, mensagem %s perdida: %s", oid, e)
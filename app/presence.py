@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from redis.exceptions import RedisError
+from app.config import settings, redis, redis_for
+from app.manager import room_channel
+from app.ratelimit import NOW_LUA
+
+log = logging.getLogger(__name__)
+
+# Presença por sala num ZSET `presence:{room}` (membro = usuário, score =
+# último heartbeat em ms, pelo relógio do Redis), num ZSET `presence:users:{room}`
+# com os mesmos membros e score 0 (ordem lexicográfica, para paginar) e um
+# HASH `presence:conns:{room}` com o número de conexões de cada usuário.
+# Entradas e saídas são publicadas no canal da sala como deltas:
+# {"type": "presence", "event": "join" | "leave", "user_id": ...}
+#
+# A contagem de conexões só muda no join e no leave de cada socket: quem é
+# varrido por falta de heartbeat mas ainda tem sockets abertos volta no
+# próximo heartbeat com a contagem intacta. Só se o HASH inteiro expirou o
+# heartbeat recria a contagem (com 1, o mínimo de quem ainda manda heartbeat).
+
+# KEYS: presence, users, conns | ARGV: usuário, ttl (ms), canal, nova conexão (1/0)
+TOUCH_LUA = NOW_LUA + """
+local added = redis.call('ZADD', KEYS[1], now, ARGV[1])
+if added == 1 then
+    redis.call('ZADD', KEYS[2], 0, ARGV[1])
+end
+if ARGV[4] == '1' then
+    redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+elseif added == 1 then
+    redis.call('HSETNX', KEYS[3], ARGV[1], 1)
+end
+for i = 1, 3 do
+    redis.call('PEXPIRE', KEYS[i], ARGV[2] * 2)
+end
+if added == 1 then
+    redis.call('PUBLISH', ARGV[3], cjson.encode({type = 'presence', event = 'join', user_id = ARGV[1]}))
+end
+return added
+"""
+
+# KEYS: presence, users, conns | ARGV: usuário, canal
+LEAVE_LUA = """
+if redis.call('HINCRBY', KEYS[3], ARGV[1], -1) > 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('PUBLISH', ARGV[2], cjson.encode({type = 'presence', event = 'leave', user_id = ARGV[1]}))
+return 1
+"""
+
+# KEYS: presence, users | ARGV: ttl (ms), canal, máximo por execução
+SWEEP_LUA = NOW_LUA + """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, user in ipairs(stale) do
+    redis.call('ZREM', KEYS[1], user)
+    redis.call('ZREM', KEYS[2], user)
+    redis.call('PUBLISH', ARGV[2], cjson.encode({type = 'presence', event = 'leave', user_id = user}))
+end
+return #stale
+"""
+
+# Página por keyset na ordem dos ids: estável entre heartbeats e O(log N)
+# mais a página, já que ZRANGEBYLEX começa direto depois do cursor. Quem
+# expirou e ainda não foi varrido é pulado aqui.
+# KEYS: presence, users | ARGV: ttl (ms), cursor (último usuário ou ''), limit
+ONLINE_LUA = NOW_LUA + """
+local min = now - ARGV[1]
+local limit = tonumber(ARGV[3])
+local count = redis.call('ZCOUNT', KEYS[1], '(' .. min, '+inf')
+local users = {}
+local start = ARGV[2] == '' and '-' or '(' .. ARGV[2]
+while #users < limit do
+    local batch = redis.call('ZRANGEBYLEX', KEYS[2], start, '+', 'LIMIT', 0, limit - #users)
+    if #batch == 0 then
+        break
+    end
+    for _, user in ipairs(batch) do
+        local score = redis.call('ZSCORE', KEYS[1], user)
+        if score and tonumber(score) > min then
+            users[#users + 1] = user
+        end
+    end
+    start = '(' .. batch[#batch]
+end
+local more = 0
+if #users == limit and #redis.call('ZRANGEBYLEX', KEYS[2], start, '+', 'LIMIT', 0, 1) > 0 then
+    more = 1
+end
+return {count, users, more}
+"""
+
+SWEEP_BATCH = 1000
+
+touch_script = redis.register_script(TOUCH_LUA)
+leave_script = redis.register_script(LEAVE_LUA)
+sweep_script = redis.register_script(SWEEP_LUA)
+online_script = redis.register_script(ONLINE_LUA)
+
+
+def presence_keys(room):
+    return [f"presence:{room}", f"presence:users:{room}", f"presence:conns:{room}"]
+
+
+def _ttl_ms():
+    return settings.PRESENCE_TTL * 1000
+
+
+async def join(room, user_id):
+    await touch_script(keys=presence_keys(room), args=[user_id, _ttl_ms(), room_channel(room), 1],
+                       client=redis_for(room))
+
+
+async def heartbeat(room, user_id):
+    await touch_script(keys=presence_keys(room), args=[user_id, _ttl_ms(), room_channel(room), 0],
+                       client=redis_for(room))
+
+
+async def leave(room, user_id):
+    await leave_script(keys=presence_keys(room), args=[user_id, room_channel(room)],
+                       client=redis_for(room))
+
+
+# Usuários com heartbeat dentro do TTL, em ordem de id; `next` é o cursor
+# (`after`) da página seguinte
+async def get_online(room, after=None, limit=100) -> dict:
+    count, users, more = await online_script(keys=presence_keys(room)[:2], args=[_ttl_ms(), after or "", limit],
+                                             client=redis_for(room))
+    return {"count": count, "users": users, "next": users[-1] if more else None}
+
+
+# Remove periodicamente quem parou de mandar heartbeat nas salas com
+# conexões neste processo. Salas abandonadas expiram pelo TTL das chaves.
+class PresenceSweeper:
+    def __init__(self, manager):
+        self.manager = manager
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_SWEEP_INTERVAL)
+            for room in list(self.manager.active_connections):
+                try:
+                    await sweep_script(
+                        keys=presence_keys(room)[:2],
+                        args=[_ttl_ms(), room_channel(room), SWEEP_BATCH],
+                        client=redis_for(room),
+                    )
+                except RedisError as e:
+                    log.warning("presença: erro ao limpar a sala %s: %s", room, e)
@@ -0,0 +1,131 @@
+import time
+import uuid
+from app.config import settings, redis, redis_for
+
+# Estratégias de rate limit executadas no Redis. Cada fragmento Lua define
+# `allowed` a partir de KEYS[1] e ARGV[1..3] (limite, janela em ms, id único)
+# e pode ser combinado com outros comandos num único script atômico.
+NOW_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+"""
+
+# Balde de tokens: capacidade ARGV[1], reposto por completo a cada janela
+TOKEN_BUCKET_LUA = NOW_LUA + """
+local capacity = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * capacity / window)
+local allowed = tokens >= 1
+if allowed then
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], window)
+"""
+
+# Log em janela deslizante: no máximo ARGV[1] entradas nos últimos ARGV[2] ms
+SLIDING_LOG_LUA = NOW_LUA + """
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local allowed = redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1])
+if allowed then
+    redis.call('ZADD', KEYS[1], now, ARGV[3])
+end
+redis.call('PEXPIRE', KEYS[1], window)
+"""
+
+# Janela fixa: a expiração é definida só na abertura da janela
+FIXED_WINDOW_LUA = """
+local count = redis.call('INCR', KEYS[1])
+if count == 1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+local allowed = count <= tonumber(ARGV[1])
+"""
+
+STRATEGIES = {
+    "token_bucket": TOKEN_BUCKET_LUA,
+    "sliding_log": SLIDING_LOG_LUA,
+    "fixed_window": FIXED_WINDOW_LUA,
+}
+
+# Estratégias que a pré-checagem local consegue espelhar. A janela fixa
+# reabre de uma vez numa fronteira que só o Redis conhece (o primeiro INCR),
+# e o balde local, que repõe aos poucos, rejeitaria a rajada logo após ela.
+LOCAL_STRATEGIES = {"token_bucket", "sliding_log"}
+
+# Entradas locais ociosas são descartadas a cada SWEEP_EVERY checagens
+SWEEP_EVERY = 10000
+
+
+def rate_key(room, user_id):
+    return f"rl:{room}:{user_id}"
+
+
+class RateLimiter:
+    def __init__(self, strategy=None, local=None):
+        self.strategy = strategy or settings.RATE_LIMIT_STRATEGY
+        self.lua = STRATEGIES[self.strategy]
+        self.script = redis.register_script(self.lua + "\nreturn allowed and 1 or 0")
+        use_local = settings.RATE_LIMIT_LOCAL if local is None else local
+        self.use_local = use_local and self.strategy in LOCAL_STRATEGIES
+        self.local = {}  # (room, user_id): [tokens, ts]
+        self.checks = 0
+        self.local_rejected = 0
+
+    def limit_for(self, room, user_id) -> int:
+        if user_id in settings.RATE_LIMIT_USERS:
+            return settings.RATE_LIMIT_USERS[user_id]
+        return settings.RATE_LIMIT_ROOMS.get(room, settings.RATE_LIMIT)
+
+    def args(self, room, user_id) -> list:
+        return [self.limit_for(room, user_id), settings.RATE_WINDOW_MS, uuid.uuid4().hex]
+
+    # Balde de tokens em memória com o mesmo limite do Redis. Só consome o
+    # que o Redis também aceitou (ver refund) e repõe cada token em no máximo
+    # uma janela, então nunca fica mais restrito que o token_bucket ou o
+    # sliding_log globais: apenas corta rajadas sem round-trip.
+    def precheck(self, room, user_id) -> bool:
+        if not self.use_local:
+            return True
+        now = time.monotonic()
+        self.checks += 1
+        if self.checks % SWEEP_EVERY == 0:
+            self._sweep(now)
+        capacity = self.limit_for(room, user_id)
+        window = settings.RATE_WINDOW_MS / 1000
+        bucket = self.local.get((room, user_id))
+        if bucket is None:
+            bucket = self.local[(room, user_id)] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * capacity / window)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.local_rejected += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def refund(self, room, user_id):
+        bucket = self.local.get((room, user_id))
+        if bucket is not None:
+            bucket[0] += 1
+
+    async def check(self, room, user_id) -> bool:
+        if not self.precheck(room, user_id):
+            return False
+        allowed = bool(await self.script(
+            keys=[rate_key(room, user_id)], args=self.args(room, user_id), client=redis_for(room),
+        ))
+        if not allowed:
+            self.refund(room, user_id)
+        return allowed
+
+    def _sweep(self, now):
+        window = settings.RATE_WINDOW_MS / 1000
+        idle = [key for key, (_, ts) in self.local.items() if now - ts > window]
+        for key in idle:
+            del self.local[key]
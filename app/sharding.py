@@ -0,0 +1,25 @@
+import bisect
+import hashlib
+
+VNODES = 160  # pontos por shard no anel
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+# Hash consistente: adicionar ou remover um shard só move as salas vizinhas
+# no anel, e todos os processos com a mesma lista de URIs concordam sobre
+# o shard de cada sala.
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        points = sorted(
+            (_hash(f"{node}#{i}"), index)
+            for index, node in enumerate(nodes) for i in range(vnodes)
+        )
+        self.hashes = [h for h, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def get(self, key: str) -> int:
+        pos = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.indexes[pos]
@@ -1,26 +1,46 @@
-import json
-from app.config import redis
+from app import metrics
+from app.config import redis, redis_for
+from app.ratelimit import RateLimiter, rate_key
 
-# Rate limit: 5 msg/sec por usuário/sala
-async def rate_limit_check(room, user_id):
-    key = f"rl:{room}:{user_id}"
-    count = await redis.incr(key)
-    await redis.expire(key, 1)
-    return count <= 5
+RECENT_SIZE = 50
 
-# Presença online
-async def set_online(room, user_id):
-    key = f"online:{room}"
-    await redis.sadd(key, user_id)
-    await redis.expire(key, 60)
+limiter = RateLimiter()
 
-# Histórico recente (máx. 50 mensagens)
-async def add_recent(room, msg: dict):
-    key = f"recent:{room}"
-    await redis.lpush(key, json.dumps(msg))
-    await redis.ltrim(key, 0, 49)
+# Caminho quente de uma mensagem num único round-trip (EVALSHA):
+# rate limit, histórico recente, write-ahead log opcional e publish.
+# KEYS: rl:{room}:{user_id}, recent:{room}, [wal:messages]
+# ARGV: limite, janela (ms), id único, payload, canal, tamanho do histórico, [_id]
+SEND_MESSAGE_LUA = limiter.lua + """
+if not allowed then
+    return 0
+end
+redis.call('LPUSH', KEYS[2], ARGV[4])
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[6]) - 1)
+if #KEYS > 2 then
+    redis.call('XADD', KEYS[3], '*', 'id', ARGV[7], 'doc', ARGV[4])
+end
+redis.call('PUBLISH', ARGV[5], ARGV[4])
+return 1
+"""
+send_message_script = redis.register_script(SEND_MESSAGE_LUA)
+
+# Retorna False se o usuário excedeu o rate limit (nada é gravado nem publicado)
+async def send_message(room, user_id, payload: str, channel: str, wal_stream=None, wal_id=None):
+    with metrics.timed("rate_limit"):
+        if not limiter.precheck(room, user_id):
+            return False
+    keys = [rate_key(room, user_id), f"recent:{room}"]
+    args = limiter.args(room, user_id) + [payload, channel, RECENT_SIZE]
+    if wal_stream:
+        keys.append(wal_stream)
+        args.append(wal_id)
+    with metrics.timed("redis_send"):
+        allowed = bool(await send_message_script(keys=keys, args=args, client=redis_for(room)))
+    if not allowed:
+        limiter.refund(room, user_id)
+    return allowed
 
-async def get_recent(room):
+# Mensagens recentes ainda serializadas em JSON, da mais nova para a mais antiga
+async def get_recent_raw(room):
     key = f"recent:{room}"
-    raw_msgs = await redis.lrange(key, 0, 49)
-    return [json.loads(m) for m in raw_msgs]
\ No newline at end of file
+    return await redis_for(room).lrange(key, 0, RECENT_SIZE - 1)
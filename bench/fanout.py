@@ -0,0 +1,68 @@
+# Carga de fan-out: mede quantos envios e quanto tempo cada publish custa
+# conforme o tamanho da sala. Com um único assinante por processo o custo
+# cresce linearmente (N envios por mensagem), e não N×N. Sai com erro se
+# algum frame for descartado.
+#
+# Uso: REDIS_URI=redis://localhost:6379/0 python -m bench.fanout
+import asyncio
+import json
+import time
+from app.config import redis
+from app.manager import ConnectionManager, room_channel
+
+MESSAGES = 200
+SIZES = (10, 50, 100, 500, 1000)
+
+
+class FakeWebSocket:
+    def __init__(self, counter):
+        self.counter = counter
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, frame):
+        self.counter["sends"] += 1
+
+    async def close(self, code=1000):
+        pass
+
+
+async def run(size):
+    manager = ConnectionManager()
+    counter = {"sends": 0}
+    room = f"bench-{size}"
+    clients = [await manager.connect(FakeWebSocket(counter), room) for _ in range(size)]
+
+    expected = size * MESSAGES
+    payload = json.dumps({"user_id": "bench", "room": room, "content": "x"})
+    start = time.perf_counter()
+    # Publica em rajada (pipeline): as mensagens chegam juntas ao assinante
+    async with redis.pipeline(transaction=False) as pipe:
+        for _ in range(MESSAGES):
+            pipe.publish(room_channel(room), payload)
+        await pipe.execute()
+    while counter["sends"] + manager.dropped_frames < expected:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        await manager.disconnect(client)
+    await manager.close()
+    return counter["sends"], manager.dropped_frames, elapsed
+
+
+async def main():
+    print(f"{'sala':>6} {'envios/msg':>11} {'descartes':>10} {'us/envio':>9} {'ms/msg':>8}")
+    failed = False
+    for size in SIZES:
+        sends, dropped, elapsed = await run(size)
+        # Sockets de teste são instantâneos: qualquer descarte é perda indevida
+        failed |= dropped > 0
+        print(f"{size:>6} {sends / MESSAGES:>11.0f} {dropped:>10} "
+              f"{elapsed / max(sends, 1) * 1e6:>9.2f} {elapsed / MESSAGES * 1e3:>8.3f}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+# Latência de página do histórico por profundidade: semeia um milhão de
+# mensagens numa sala e mede get_history a partir de cursores em
+# profundidades crescentes. Com keyset em (room, timestamp, _id) a latência
+# fica estável, ao contrário de skip/offset. Antes, pagina uma cauda
+# `recent:{room}` fora da ordem de timestamp e falha se alguma mensagem
+# faltar ou se repetir (só essa checagem com --check).
+#
+# Uso: MONGO_URI=mongodb://localhost:27017 REDIS_URI=redis://localhost:6379/0 \
+#      python -m bench.history [--check]
+import argparse
+import asyncio
+import orjson
+import statistics
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from app.config import settings, redis_for
+from app.history import encode_cursor, ensure_indexes, get_history, recent_cursor
+
+TOTAL = 1_000_000
+BATCH = 10_000
+ROOM = "bench-history"
+DEPTHS = (0, 1_000, 10_000, 100_000, 500_000, 999_000)
+PAGE = 50
+RUNS = 20
+
+
+async def seed(collection):
+    if await collection.count_documents({"room": ROOM}) >= TOTAL:
+        return
+    await collection.delete_many({"room": ROOM})
+    start = datetime(2024, 1, 1)
+    for offset in range(0, TOTAL, BATCH):
+        await collection.insert_many([
+            {
+                "_id": ObjectId(),
+                "user_id": f"u{i % 1000}",
+                "room": ROOM,
+                "content": f"mensagem {i}",
+                "timestamp": (start + timedelta(milliseconds=i)).isoformat(timespec="microseconds"),
+            }
+            for i in range(offset, offset + BATCH)
+        ], ordered=False)
+
+
+async def cursor_at(collection, depth):
+    if depth == 0:
+        return None
+    # skip só na preparação, para posicionar o cursor
+    doc = await collection.find({"room": ROOM}) \
+        .sort([("timestamp", -1), ("_id", -1)]).skip(depth - 1).limit(1).next()
+    return encode_cursor({"timestamp": doc["timestamp"], "id": str(doc["_id"])})
+
+
+# LPUSH em ordem diferente da do timestamp, como com dois workers cujos
+# relógios divergem; a primeira página vem do cursor do frame `recent`
+async def check_tail_order(collection):
+    room = f"{ROOM}-cauda"
+    key = f"recent:{room}"
+    await collection.delete_many({"room": room})
+    await redis_for(room).delete(key)
+    start = datetime(2024, 1, 1)
+    expected = []
+    for i, ms in enumerate((3, 1, 2, 7, 5, 6, 4)):
+        msg = {
+            "id": str(ObjectId()), "user_id": "u", "room": room, "content": f"m{i}",
+            "timestamp": (start + timedelta(milliseconds=ms)).isoformat(timespec="microseconds"),
+        }
+        await redis_for(room).lpush(key, orjson.dumps(msg))
+        expected.append(msg["content"])
+    ok = True
+    for limit in (1, 2, 3):
+        seen = []
+        before = None
+        while True:
+            page = await get_history(collection, room, before, limit)
+            seen += [msg["content"] for msg in page["messages"]]
+            before = page["next"]
+            if before is None:
+                break
+        # Do frame `recent` em diante: nada além do que a cauda já entregou
+        rest = await get_history(collection, room, recent_cursor(await redis_for(room).lrange(key, 0, -1)), limit)
+        good = sorted(seen) == sorted(expected) and not rest["messages"]
+        ok &= good
+        print(f"cauda fora de ordem, limit={limit}: {seen} {'ok' if good else 'FALHOU'}")
+    await redis_for(room).delete(key)
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="só a checagem da cauda fora de ordem")
+    args = parser.parse_args()
+    if settings.FAKE_BACKENDS:
+        from mongomock_motor import AsyncMongoMockClient
+        collection = AsyncMongoMockClient(settings.MONGO_URI).chatdb.messages
+    else:
+        collection = AsyncIOMotorClient(settings.MONGO_URI).chatdb.messages
+    if not await check_tail_order(collection):
+        raise SystemExit(1)
+    if args.check:
+        return
+    await ensure_indexes(collection)
+    await seed(collection)
+    await redis_for(ROOM).delete(f"recent:{ROOM}")
+    print(f"{'profundidade':>12} {'p50 ms':>8} {'max ms':>8}")
+    for depth in DEPTHS:
+        before = await cursor_at(collection, depth)
+        timings = []
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            page = await get_history(collection, ROOM, before, PAGE)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert len(page["messages"]) == PAGE
+        print(f"{depth:>12} {statistics.median(timings):>8.2f} {max(timings):>8.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
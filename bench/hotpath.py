@@ -0,0 +1,54 @@
+# Microbenchmark do caminho quente no Redis: a sequência antiga de comandos
+# (incr, expire, lpush, ltrim, publish) contra o script Lua via EVALSHA.
+#
+# Uso: REDIS_URI=redis://localhost:6379/0 python -m bench.hotpath
+import asyncio
+import json
+import time
+from app.config import redis_for
+from app.manager import room_channel
+from app.utils import send_message
+
+MESSAGES = 20000
+ROOM = "bench-hotpath"
+PAYLOAD = json.dumps({"user_id": "bench", "room": ROOM, "content": "x" * 64})
+# O mesmo shard em que send_message grava a sala
+redis = redis_for(ROOM)
+
+
+# Usuários diferentes em cada caminho: o rate limit do script guarda um HASH
+# (token_bucket) ou ZSET na mesma chave em que o caminho antigo faz INCR
+async def sequential(i):
+    key = f"rl:{ROOM}:old{i}"
+    count = await redis.incr(key)
+    await redis.expire(key, 1)
+    if count > 5:
+        return False
+    await redis.lpush(f"recent:{ROOM}", PAYLOAD)
+    await redis.ltrim(f"recent:{ROOM}", 0, 49)
+    await redis.publish(room_channel(ROOM), PAYLOAD)
+    return True
+
+
+async def scripted(i):
+    return await send_message(ROOM, f"u{i}", PAYLOAD, room_channel(ROOM))
+
+
+async def measure(fn):
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        await fn(i)
+    return MESSAGES / (time.perf_counter() - start)
+
+
+async def main():
+    await scripted(-1)  # carrega o script (SCRIPT LOAD) fora da medição
+    before = await measure(sequential)
+    after = await measure(scripted)
+    print(f"antes  (6 round-trips): {before:>10.0f} msgs/s")
+    print(f"depois (1 EVALSHA):     {after:>10.0f} msgs/s  ({after / before:.1f}x)")
+    await redis.delete(f"recent:{ROOM}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
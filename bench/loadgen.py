@@ -0,0 +1,186 @@
+# Gerador de carga: abre milhares de clientes WebSocket em /ws/{room}/{user_id},
+# cada um enviando mensagens numa taxa fixa, e mede a latência de entrega
+# ponta a ponta (envio -> recebimento em cada socket da sala).
+#
+# Uso (servidor já rodando):
+#   python -m bench.loadgen --clients 2000 --rooms 50 --rate 1 --duration 30
+# Ou sobe o servidor com Redis/MongoDB em memória (fakeredis/mongomock-motor):
+#   python -m bench.loadgen --spawn --clients 500
+#
+# Requer `websockets` (incluído em uvicorn[standard]).
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+import orjson
+import websockets
+
+PREFIX = "lg:"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Carga no chat via WebSocket")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="uniform",
+                        help="distribuição dos clientes entre as salas")
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--rate", type=float, default=1.0, help="mensagens/s por cliente")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--spawn", action="store_true",
+                        help="sobe o servidor com FAKE_BACKENDS=true (um worker)")
+    return parser.parse_args()
+
+
+def assign_rooms(args):
+    rooms = [f"lg-{i}" for i in range(args.rooms)]
+    if args.distribution == "zipf":
+        weights = [1 / (k ** args.zipf_s) for k in range(1, args.rooms + 1)]
+    else:
+        weights = None
+    return random.choices(rooms, weights=weights, k=args.clients)
+
+
+def scrape_rss(url):
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as resp:
+            for line in resp.read().decode().splitlines():
+                if line.startswith("process_resident_memory_bytes"):
+                    return float(line.rsplit(" ", 1)[1])
+    except OSError:
+        pass
+    return None
+
+
+def wait_ready(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("servidor não respondeu em /health")
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.rate_limited = 0
+        self.latencies = []
+        self.measuring = False
+
+
+def handle(frame, stats):
+    kind = frame.get("type")
+    if kind == "batch":
+        for item in frame.get("messages", []):
+            handle(item, stats)
+    elif kind == "error":
+        stats.rate_limited += 1
+    elif kind is None and str(frame.get("content", "")).startswith(PREFIX):
+        if stats.measuring:
+            stats.latencies.append(time.time() - float(frame["content"][len(PREFIX):]))
+            stats.delivered += 1
+
+
+async def reader(ws, stats):
+    async for raw in ws:
+        handle(orjson.loads(raw), stats)
+
+
+async def writer(ws, args, stats, stop):
+    interval = 1 / args.rate
+    await asyncio.sleep(random.random() * interval)
+    while not stop.is_set():
+        await ws.send(orjson.dumps({"content": f"{PREFIX}{time.time()}"}).decode())
+        if stats.measuring:
+            stats.sent += 1
+        await asyncio.sleep(interval)
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    ws_url = args.url.replace("http", "ws", 1)
+    stats = Stats()
+    stop = asyncio.Event()
+    sockets = []
+    sem = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(i, room):
+        async with sem:
+            ws = await websockets.connect(f"{ws_url}/ws/{room}/lg-user-{i}", max_size=None)
+            sockets.append(ws)
+
+    rss_before = scrape_rss(args.url)
+    start = time.perf_counter()
+    await asyncio.gather(*[connect(i, room) for i, room in enumerate(assign_rooms(args))])
+    connect_time = time.perf_counter() - start
+    await asyncio.sleep(1)
+    rss_after = scrape_rss(args.url)
+
+    tasks = [asyncio.create_task(reader(ws, stats)) for ws in sockets]
+    tasks += [asyncio.create_task(writer(ws, args, stats, stop)) for ws in sockets]
+    await asyncio.sleep(2)  # aquecimento
+    stats.measuring = True
+    measure_start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stats.measuring = False
+    elapsed = time.perf_counter() - measure_start
+    stop.set()
+    await asyncio.sleep(1)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*[ws.close() for ws in sockets], return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    print(f"clientes:        {len(sockets)} em {args.rooms} salas ({args.distribution}), "
+          f"conectados em {connect_time:.1f}s")
+    print(f"enviadas:        {stats.sent} ({stats.sent / elapsed:.0f} msgs/s)")
+    print(f"entregues:       {stats.delivered} ({stats.delivered / elapsed:.0f} msgs/s)")
+    print(f"rate limited:    {stats.rate_limited}")
+    print(f"latência (ms):   p50 {percentile(latencies, 0.5) * 1000:.2f}  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}  "
+          f"p999 {percentile(latencies, 0.999) * 1000:.2f}")
+    if rss_before is not None and rss_after is not None:
+        per_conn = (rss_after - rss_before) / max(1, len(sockets))
+        print(f"memória/conexão: {per_conn / 1024:.1f} KiB (RSS do servidor)")
+
+
+def main():
+    args = parse_args()
+    server = None
+    if args.spawn:
+        port = args.url.rsplit(":", 1)[-1]
+        env = {**os.environ, "FAKE_BACKENDS": "true"}
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", port, "--log-level", "warning"],
+            env=env,
+        )
+    try:
+        wait_ready(args.url)
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Admissão do rate limit sob remetentes concorrentes: vários "workers"
+# (instâncias independentes de RateLimiter) disputam a mesma chave, com e
+# sem a pré-checagem local e com limites por sala e por usuário. Nenhuma
+# estratégia pode admitir mais que o limite permite na duração do teste,
+# nem menos que um limite cheio por janela completa (a pré-checagem local
+# não pode ser mais restrita que o Redis).
+#
+# Uso: REDIS_URI=redis://localhost:6379/0 python -m bench.ratelimit
+import asyncio
+import time
+from app.config import settings, redis_for
+from app.ratelimit import STRATEGIES, RateLimiter, rate_key
+
+WORKERS = 8
+SENDERS_PER_WORKER = 16
+DURATION = 3.0
+USER = "flood"
+
+# (nome, pré-checagem local, limite da sala, limite do usuário)
+CASES = [
+    ("global", False, None, None),
+    ("local", True, None, None),
+    ("sala", True, settings.RATE_LIMIT * 2, None),
+    ("usuário", True, settings.RATE_LIMIT * 2, max(1, settings.RATE_LIMIT // 2)),
+]
+
+
+async def sender(limiter, room, deadline, admitted):
+    while time.monotonic() < deadline:
+        if await limiter.check(room, USER):
+            admitted.append(time.monotonic())
+        # A rejeição local não toca o Redis nem cede o loop; sem isto um único
+        # remetente giraria sozinho até o prazo (no app, o receive cede)
+        await asyncio.sleep(0)
+
+
+async def run(strategy, local, room_limit, user_limit):
+    room = f"bench-{strategy}-{'local' if local else 'global'}-{room_limit}-{user_limit}"
+    if room_limit is not None:
+        settings.RATE_LIMIT_ROOMS[room] = room_limit
+    if user_limit is not None:
+        settings.RATE_LIMIT_USERS[USER] = user_limit
+    try:
+        await redis_for(room).delete(rate_key(room, USER))
+        limiters = [RateLimiter(strategy, local=local) for _ in range(WORKERS)]
+        limit = limiters[0].limit_for(room, USER)
+        admitted = []
+        deadline = time.monotonic() + DURATION
+        await asyncio.gather(*[
+            sender(limiter, room, deadline, admitted)
+            for limiter in limiters for _ in range(SENDERS_PER_WORKER)
+        ])
+    finally:
+        settings.RATE_LIMIT_ROOMS.pop(room, None)
+        settings.RATE_LIMIT_USERS.pop(USER, None)
+    windows = DURATION / (settings.RATE_WINDOW_MS / 1000)
+    # Rajada inicial de `limit` mais a taxa sustentada
+    ceiling = limit * (1 + windows)
+    floor = limit * int(windows)
+    return len(admitted), floor, ceiling
+
+
+# Rajadas em volta da virada da janela: 1 mensagem, o resto do limite no
+# fim da janela e um limite cheio logo após a virada. Com e sem pré-checagem
+# local o Redis decide igual, então as contagens devem bater (±1 pelo token
+# fracionário medido um instante antes no processo).
+async def boundary(strategy):
+    window = settings.RATE_WINDOW_MS / 1000
+    limit = settings.RATE_LIMIT
+    counts = []
+    for local in (False, True):
+        room = f"bench-{strategy}-virada-{'local' if local else 'global'}"
+        await redis_for(room).delete(rate_key(room, USER))
+        limiter = RateLimiter(strategy, local=local)
+        admitted = 0
+        for delay, burst in ((0, 1), (0.9, limit - 1), (0.15, limit)):
+            await asyncio.sleep(delay * window)
+            for _ in range(burst):
+                admitted += await limiter.check(room, USER)
+        counts.append(admitted)
+    return counts
+
+
+async def main():
+    failed = False
+    for strategy in STRATEGIES:
+        remote, local = await boundary(strategy)
+        ok = abs(remote - local) <= 1
+        failed |= not ok
+        print(f"{strategy:>13}   virada: {local:>4} admitidas (Redis: {remote}) {'ok' if ok else 'FALHOU'}")
+    for strategy in STRATEGIES:
+        for name, local, room_limit, user_limit in CASES:
+            count, floor, ceiling = await run(strategy, local, room_limit, user_limit)
+            ok = floor <= count <= ceiling
+            failed |= not ok
+            print(f"{strategy:>13} {name:>8}: {count:>4} admitidas "
+                  f"({floor}..{ceiling:.0f}) {'ok' if ok else 'FALHOU'}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())